@@ -1,14 +1,51 @@
+import json
+import platform
+import queue
+import re
 import sqlite3
 import sys
 import shutil
 import os
+import threading
 import time
 import zipfile
 import tempfile
 import unittest
-from bs4 import BeautifulSoup
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from lxml import html as lxml_html
 from tqdm import tqdm
-from multiprocessing import Pool, cpu_count
+from multiprocessing import Pool, cpu_count, get_start_method
+
+# selectolax wraps the Lexbor C parser, which is markedly faster than
+# libxml2 on small fragments. It's optional: without the extension the
+# worker falls back to the lxml path below.
+try:
+    from selectolax.parser import HTMLParser as LexborHTMLParser
+except ImportError:
+    LexborHTMLParser = None
+
+# Only these top-level tags are ever inspected; filtering for them at the
+# C level keeps irrelevant siblings (comments, styling wrappers) from even
+# reaching the Python loop.
+TOP_LEVEL_TAGS = ('h3', 'p', 'ul')
+
+# Notes are shipped to workers in batches of this size so pickle/queue
+# overhead is paid once per batch instead of once per note.
+NOTE_BATCH_SIZE = 256
+
+# The writer thread commits updates in transactions of this many rows.
+UPDATE_FLUSH_SIZE = 5000
+
+# Media formats that are already compressed; deflating them again wastes
+# CPU for near-zero size gain, so they are stored as-is on repack.
+STORED_EXTENSIONS = {'.mp3', '.ogg', '.opus', '.jpg', '.jpeg', '.png', '.webp', '.mp4', '.webm'}
+
+# The common malformed pattern — an unclosed <rb> swallowing its <rt> —
+# is local enough to fix with a compiled regex, without building a tree.
+MALFORMED_RUBY_RE = re.compile(r'<ruby><rb>([^<]+)<rt>([^<]+)</ruby>')
+MALFORMED_RUBY_SUB = r'<ruby><rb>\1</rb><rt>\2</rt></ruby>'
 
 def simplify_ruby_html(note_data):
     """
@@ -18,118 +55,445 @@ def simplify_ruby_html(note_data):
     # The first element of the tuple is the note_id.
     # The second is the fields string.
     note_id, flds = note_data
-    fields = flds.split('\x1f')
-    
-    # Ensure the field exists before trying to access it
-    if len(fields) < 2:
+
+    # Field 1 sits between the first and second separators; slicing just
+    # that span out avoids splitting and rejoining every field on notes
+    # that commonly carry many of them.
+    i = flds.find('\x1f')
+    if i == -1:
+        # Ensure the field exists before trying to access it
         return None
-    
-    original_html = fields[1]
+    j = flds.find('\x1f', i + 1)
+    if j == -1:
+        j = len(flds)
+
+    original_html = flds[i + 1:j]
 
     if not original_html.strip():
         return None
 
-    # --- HTML Parsing Logic ---
-    soup = BeautifulSoup(original_html, 'html.parser')
+    cleaned_html = _simplify_html(original_html)
+    if cleaned_html is None:
+        return None
+
+    return (note_id, flds[:i + 1] + cleaned_html + flds[j:])
+
+
+# Decks are full of template-generated boilerplate, so identical field
+# HTML recurs constantly; memoizing the pure transformation lets each
+# worker process parse each distinct fragment once.
+@lru_cache(maxsize=65536)
+def _simplify_html(original_html):
+    """Pure transformation: returns the cleaned HTML, or None if unchanged."""
+    # Fast path: the cleanups only matter for notes containing ruby
+    # annotations or lists. Two C-level substring scans are far cheaper
+    # than parsing, and most notes in a typical deck have neither.
+    if '<ruby' not in original_html and '<ul' not in original_html:
+        return None
+
+    # Ruby-only notes get the regex treatment; the full parse is only
+    # needed when a <ul> requires link filtering.
+    if '<ul' not in original_html:
+        cleaned_html = MALFORMED_RUBY_RE.sub(MALFORMED_RUBY_SUB, original_html)
+        return cleaned_html if cleaned_html != original_html else None
+
+    if LexborHTMLParser is not None:
+        cleaned_html = _simplify_with_lexbor(original_html)
+    else:
+        cleaned_html = _simplify_with_lxml(original_html)
+
+    return cleaned_html if cleaned_html != original_html else None
+
+
+def _simplify_with_lxml(original_html):
+    """Simplifies a note body using lxml's C-backed element tree."""
+    # Skipping bs4's Python-side tree construction is several times
+    # faster again on top of the lxml parser itself.
+    root = lxml_html.fragment_fromstring(original_html, create_parent='div')
     simplified_parts = []
-    for element in soup.find_all(recursive=False):
-        if element.name == 'h3':
-            simplified_parts.append(f"<h3>{element.get_text().strip()}</h3>")
-        elif element.name == 'p':
-            paragraph_content = ""
-            for content in element.contents:
-                if content.name == 'ruby':
-                    rt_tag = content.find('rt')
-                    rb_tag = content.find('rb')
-                    if rb_tag:
-                        if rt_tag and rt_tag.find_parent() == rb_tag:
-                            rt_tag.extract()
-                        rt_text = rt_tag.get_text() if rt_tag else ""
-                        rb_text = rb_tag.get_text()
+    for element in root.iterchildren(*TOP_LEVEL_TAGS):
+        if element.tag == 'h3':
+            simplified_parts.append(f"<h3>{element.text_content().strip()}</h3>")
+        elif element.tag == 'p':
+            # append + single join keeps concatenation linear; += on a
+            # string reallocates the whole buffer per element.
+            paragraph_parts = []
+            if element.text and element.text.strip():
+                paragraph_parts.append(element.text.strip())
+            for content in element.iterchildren():
+                if content.tag == 'ruby':
+                    rt_tag = content.find('.//rt')
+                    rb_tag = content.find('.//rb')
+                    if rb_tag is not None:
+                        if rt_tag is not None and rt_tag.getparent() is rb_tag:
+                            # Malformed <rb>text<rt>reading</rb>: detach the
+                            # reading so it doesn't leak into the base text,
+                            # but keep any text that followed it.
+                            tail = rt_tag.tail
+                            rb_tag.remove(rt_tag)
+                            if tail:
+                                rb_tag.text = (rb_tag.text or "") + tail
+                        rt_text = rt_tag.text_content() if rt_tag is not None else ""
+                        rb_text = rb_tag.text_content()
                         if rt_text.strip():
-                            paragraph_content += f"<ruby><rb>{rb_text}</rb><rt>{rt_text}</rt></ruby>"
+                            paragraph_parts.append(f"<ruby><rb>{rb_text}</rb><rt>{rt_text}</rt></ruby>")
                         else:
-                            paragraph_content += rb_text
-                elif content.string:
-                    stripped_string = content.string.strip()
-                    if stripped_string:
-                        paragraph_content += stripped_string
-            simplified_parts.append(f"<p>{paragraph_content}</p>")
-        elif element.name == 'ul':
+                            paragraph_parts.append(rb_text)
+                elif len(content) == 0 and content.text and content.text.strip():
+                    paragraph_parts.append(content.text.strip())
+                # Text between tags lives on the preceding element's tail.
+                if content.tail and content.tail.strip():
+                    paragraph_parts.append(content.tail.strip())
+            simplified_parts.append(f"<p>{''.join(paragraph_parts)}</p>")
+        elif element.tag == 'ul':
             # NEW LOGIC: Filter list items
             valid_list_items = []
-            for li in element.find_all('li'):
+            for li in element.iter('li'):
                 # Check if the list item is "link-only"
                 # This is true if its only non-whitespace content is a single <a> tag.
-                non_whitespace_children = [c for c in li.contents if not (isinstance(c, str) and c.strip() == '')]
-                
-                is_link_only = len(non_whitespace_children) == 1 and non_whitespace_children[0].name == 'a'
-                
+                children = list(li)
+                is_link_only = (len(children) == 1 and children[0].tag == 'a'
+                                and not (li.text and li.text.strip())
+                                and not (children[0].tail and children[0].tail.strip()))
+
                 if not is_link_only:
-                    valid_list_items.append(f"<li>{li.get_text().strip()}</li>")
+                    valid_list_items.append(f"<li>{li.text_content().strip()}</li>")
 
             # Only add the <ul> if it's not empty after filtering
             if valid_list_items:
                 simplified_parts.append(f"<ul>{''.join(valid_list_items)}</ul>")
             # END OF NEW LOGIC
-            
-    cleaned_html = "\n".join(simplified_parts)
-    # --- End HTML Logic ---
 
-    if original_html != cleaned_html:
-        fields[1] = cleaned_html
-        new_flds = '\x1f'.join(fields)
-        return (note_id, new_flds)
-            
-    return None
+    return "\n".join(simplified_parts)
+
+
+def _simplify_with_lexbor(original_html):
+    """Simplifies a note body using selectolax's Lexbor-backed tree."""
+    body = LexborHTMLParser(original_html).body
+    if body is None:
+        return ""
+    simplified_parts = []
+    for element in body.iter(include_text=False):
+        if element.tag == 'h3':
+            simplified_parts.append(f"<h3>{element.text(deep=True).strip()}</h3>")
+        elif element.tag == 'p':
+            paragraph_parts = []
+            for content in element.iter(include_text=True):
+                if content.tag == 'ruby':
+                    rb_tag = content.css_first('rb')
+                    rt_tag = content.css_first('rt')
+                    if rb_tag is not None:
+                        rt_text = rt_tag.text(deep=True) if rt_tag is not None else ""
+                        # Lexbor closes an unclosed <rb> per the HTML5 spec,
+                        # but guard against an <rt> still nested inside it.
+                        # A direct parent-pointer compare is enough and
+                        # cheaper than a second CSS search within <rb>.
+                        if (rt_tag is not None and rt_tag.parent is not None
+                                and rt_tag.parent.mem_id == rb_tag.mem_id):
+                            rt_tag.decompose()
+                            rt_tag = None
+                        # lxml keeps everything after an unclosed <rb> nested
+                        # inside it, so its base text swallows trailing text
+                        # and further <rb>/<rt> pairs; Lexbor's auto-close
+                        # scatters them across ruby's children instead. Merge
+                        # everything after <rb> (except the extracted reading)
+                        # back into the base text to match the lxml backend.
+                        rb_parts = []
+                        seen_rb = False
+                        for child in content.iter(include_text=True):
+                            if not seen_rb:
+                                if child.tag == 'rb' and child.mem_id == rb_tag.mem_id:
+                                    seen_rb = True
+                                    rb_parts.append(child.text(deep=True))
+                                continue
+                            if (rt_tag is not None and child.tag == 'rt'
+                                    and child.mem_id == rt_tag.mem_id):
+                                continue
+                            rb_parts.append(child.text(deep=True))
+                        rb_text = ''.join(rb_parts) if seen_rb else rb_tag.text(deep=True)
+                        if rt_text.strip():
+                            paragraph_parts.append(f"<ruby><rb>{rb_text}</rb><rt>{rt_text}</rt></ruby>")
+                        else:
+                            paragraph_parts.append(rb_text)
+                elif content.tag == '-text':
+                    stripped_string = content.text(deep=False).strip()
+                    if stripped_string:
+                        paragraph_parts.append(stripped_string)
+                elif next(content.iter(include_text=False), None) is None:
+                    text = content.text(deep=False).strip()
+                    if text:
+                        paragraph_parts.append(text)
+            simplified_parts.append(f"<p>{''.join(paragraph_parts)}</p>")
+        elif element.tag == 'ul':
+            valid_list_items = []
+            for li in element.css('li'):
+                # A list item is "link-only" if its only non-whitespace
+                # content is a single <a> tag.
+                children = [c for c in li.iter(include_text=True)
+                            if not (c.tag == '-text' and not c.text(deep=False).strip())]
+                is_link_only = len(children) == 1 and children[0].tag == 'a'
+
+                if not is_link_only:
+                    valid_list_items.append(f"<li>{li.text(deep=True).strip()}</li>")
+
+            if valid_list_items:
+                simplified_parts.append(f"<ul>{''.join(valid_list_items)}</ul>")
+
+    return "\n".join(simplified_parts)
+
+
+def simplify_ruby_html_batch(batch):
+    """Worker entry point: cleans a batch of notes, returning only the updates."""
+    return [upd for upd in map(simplify_ruby_html, batch) if upd is not None]
+
+
+# Populated in the parent just before the pool forks; children inherit it
+# via copy-on-write, so note payloads never cross the pickling queue.
+_forked_notes = None
+
+
+def _simplify_note_span(span):
+    """Worker entry point for the fork path: cleans notes [start, end)."""
+    start, end = span
+    return simplify_ruby_html_batch(_forked_notes[start:end])
+
+
+def iter_note_batches(cur, batch_size=NOTE_BATCH_SIZE):
+    """Yields lists of (id, flds) rows from the cursor in fetchmany batches."""
+    while True:
+        rows = cur.fetchmany(batch_size)
+        if not rows:
+            return
+        yield rows
+
+
+def _init_worker():
+    """Pool initializer: warms per-process parser state once.
+
+    The first parse in a process pays lazy setup (libxml2's default
+    parser, Lexbor's allocator, the sre cache); running a throwaway
+    fragment through both backends here keeps that cost off the first
+    real note of every worker.
+    """
+    warmup = "<ul><li>x</li></ul>"
+    _simplify_with_lxml(warmup)
+    if LexborHTMLParser is not None:
+        _simplify_with_lexbor(warmup)
+    MALFORMED_RUBY_RE.search(warmup)
+
+
+def _update_writer(db_path, update_queue, state):
+    """Writer-thread loop: drains (flds, mod, id) rows from the queue and
+    applies them in batched transactions while the workers keep parsing."""
+    applied = 0
+    sentinel_seen = False
+    con = None
+    cur = None
+    try:
+        buffer = []
+
+        def flush():
+            nonlocal applied
+            cur.execute("BEGIN IMMEDIATE")
+            cur.executemany("UPDATE notes SET flds = ?, mod = ? WHERE id = ?", buffer)
+            con.commit()
+            applied += len(buffer)
+            buffer.clear()
+
+        while True:
+            row = update_queue.get()
+            if row is None:
+                sentinel_seen = True
+                break
+            if con is None:
+                # The writer owns its own connection; WAL mode (set by the
+                # main connection, persistent in the file) lets it commit
+                # while the main thread is still reading. Connect lazily on
+                # the first update: results only arrive after the pool has
+                # forked, so children never inherit this connection while
+                # its locks are mid-setup.
+                con = sqlite3.connect(db_path, isolation_level=None)
+                cur = con.cursor()
+                cur.execute("PRAGMA synchronous=NORMAL")
+            buffer.append(row)
+            if len(buffer) >= UPDATE_FLUSH_SIZE:
+                flush()
+        if buffer:
+            flush()
+    except Exception as exc:
+        state['error'] = exc
+        # Keep draining so the producer never blocks on a full queue —
+        # but only when the failure happened mid-stream. If the sentinel
+        # was already consumed (e.g. the final flush failed), the queue
+        # is empty and draining would block forever.
+        if not sentinel_seen:
+            while update_queue.get() is not None:
+                pass
+    finally:
+        # Close the cursor explicitly: the exception saved in state keeps
+        # the failing frame (and with it this cursor) alive, and sqlite
+        # only truly closes the connection — releasing its write lock —
+        # once the cursor's statement is finalized.
+        if cur is not None:
+            cur.close()
+        if con is not None:
+            con.close()
+    state['applied'] = applied
 
 
 def clean_anki2_database(db_path):
     """Runs the cleaning logic on the provided .anki2 database file using a process pool."""
     try:
-        with sqlite3.connect(db_path) as con:
-            cur = con.cursor()
-            cur.execute("SELECT id, flds FROM notes")
-            notes_to_process = cur.fetchall()
+        # One connection serves both the SELECT and UPDATE phases, so
+        # SQLite's page cache stays hot across them. isolation_level=None
+        # gives us explicit transaction control; same-thread checking is
+        # off because the pool's feeder thread consumes the cursor (only
+        # one thread touches it at a time).
+        con = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+        cur = con.cursor()
+        try:
+            # WAL + relaxed sync turns the update phase into memcpy-bound
+            # work instead of one fsync per journal commit.
+            cur.execute("PRAGMA journal_mode=WAL")
+            cur.execute("PRAGMA synchronous=NORMAL")
+            cur.execute("PRAGMA temp_store=MEMORY")
+            cur.execute("PRAGMA cache_size=-65536")
 
-        if not notes_to_process:
-            print("No notes found in the database.")
-            return
+            cur.execute("SELECT COUNT(*) FROM notes")
+            total_notes = cur.fetchone()[0]
 
-        print(f"Found {len(notes_to_process)} notes. Processing in parallel on {cpu_count()} cores...")
-        
-        with Pool() as pool:
-            results = list(tqdm(pool.imap_unordered(simplify_ruby_html, notes_to_process), 
-                                total=len(notes_to_process), 
-                                desc="Cleaning notes"))
+            if not total_notes:
+                print("No notes found in the database.")
+                return
 
-        updates_to_apply = [res for res in results if res is not None]
+            print(f"Found {total_notes} notes. Processing in parallel on {cpu_count()} cores...")
 
-        if not updates_to_apply:
-            print("No notes needed cleaning.")
-            return
-            
-        print(f"Applying {len(updates_to_apply)} updates to the database...")
-        with sqlite3.connect(db_path) as con:
-            cur = con.cursor()
+            num_batches = (total_notes + NOTE_BATCH_SIZE - 1) // NOTE_BATCH_SIZE
+
+            cur.execute("SELECT id, flds FROM notes")
+
+            # Updates are applied by a dedicated writer thread as results
+            # arrive, overlapping DB writes with parsing and keeping peak
+            # memory bounded: cleaned fields never pile up in one big list.
             timestamp = int(time.time())
-            updates_with_timestamp = [(flds, timestamp, note_id) for note_id, flds in updates_to_apply]
-            cur.executemany("UPDATE notes SET flds = ?, mod = ? WHERE id = ?", updates_with_timestamp)
-            print(f"Updated {len(updates_to_apply)} notes in the database.")
+            update_queue = queue.Queue(maxsize=4 * UPDATE_FLUSH_SIZE)
+            writer_state = {}
+            writer = threading.Thread(target=_update_writer,
+                                      args=(db_path, update_queue, writer_state))
+            writer.start()
+            try:
+                if get_start_method() == 'fork':
+                    # Forked children see the parent's note list via
+                    # copy-on-write, so tasks are just (start, end) index
+                    # pairs and no note bytes are pickled into the queue.
+                    global _forked_notes
+                    _forked_notes = cur.fetchall()
+                    spans = [(start, min(start + NOTE_BATCH_SIZE, total_notes))
+                             for start in range(0, total_notes, NOTE_BATCH_SIZE)]
+                    try:
+                        with Pool(initializer=_init_worker) as pool:
+                            for batch_updates in tqdm(pool.imap_unordered(_simplify_note_span, spans),
+                                                      total=len(spans),
+                                                      desc="Cleaning notes", unit="batch"):
+                                for note_id, flds in batch_updates:
+                                    update_queue.put((flds, timestamp, note_id))
+                    finally:
+                        _forked_notes = None
+                else:
+                    # spawn platforms (macOS/Windows) can't share memory
+                    # this way; stream fetchmany batches straight into the
+                    # pool so DB reads overlap parsing and pickle cost
+                    # stays per-batch.
+                    with Pool(initializer=_init_worker) as pool:
+                        for batch_updates in tqdm(pool.imap_unordered(simplify_ruby_html_batch,
+                                                                      iter_note_batches(cur)),
+                                                  total=num_batches,
+                                                  desc="Cleaning notes", unit="batch"):
+                            for note_id, flds in batch_updates:
+                                update_queue.put((flds, timestamp, note_id))
+            finally:
+                update_queue.put(None)
+                writer.join()
+
+            if 'error' in writer_state:
+                raise writer_state['error']
+
+            applied = writer_state.get('applied', 0)
+            if applied:
+                print(f"Updated {applied} notes in the database.")
+            else:
+                print("No notes needed cleaning.")
+        finally:
+            # Restore Anki's defaults (and checkpoint the WAL back into the
+            # main file) so the resulting .anki2 is what Anki expects —
+            # even on the early-return paths, since WAL mode is persistent.
+            # An aborted run can leave the SELECT statement pending, which
+            # would make the journal-mode change raise and mask the real
+            # error; closing the cursor resets it first.
+            cur.close()
+            if con.in_transaction:
+                con.rollback()
+            con.execute("PRAGMA journal_mode=DELETE")
+            con.execute("PRAGMA synchronous=FULL")
+            con.close()
 
     except sqlite3.Error as e:
         print(f"Database error during cleaning: {e}")
         raise
 
+def _extract_members(apkg_path, names, dest_dir):
+    """Extracts the given members using its own ZipFile handle."""
+    # Each worker thread gets a private handle; ZipFile reads are not
+    # thread-safe on a shared one. zlib releases the GIL, so threads
+    # genuinely overlap on decompression.
+    with zipfile.ZipFile(apkg_path, 'r') as z:
+        for name in names:
+            z.extract(name, dest_dir)
+
+
+def _deflate_member(file_path, arcname, compress_type):
+    """Reads and pre-compresses one file, returning a ready-to-write member."""
+    with open(file_path, 'rb') as f:
+        data = f.read()
+    if compress_type == zipfile.ZIP_DEFLATED:
+        compressor = zlib.compressobj(1, zlib.DEFLATED, -15)
+        payload = compressor.compress(data) + compressor.flush()
+    else:
+        payload = data
+    zinfo = zipfile.ZipInfo.from_file(file_path, arcname)
+    zinfo.compress_type = compress_type
+    zinfo.compress_size = len(payload)
+    zinfo.file_size = len(data)
+    zinfo.CRC = zlib.crc32(data)
+    return zinfo, payload
+
+
+def _write_raw_member(z_out, zinfo, payload):
+    """Appends an already-compressed member to an open ZipFile."""
+    zinfo.header_offset = z_out.fp.tell()
+    # Let FileHeader decide on zip64 from the member's sizes, so media
+    # over 4 GiB still repacks instead of raising LargeZipFile.
+    z_out.fp.write(zinfo.FileHeader())
+    z_out.fp.write(payload)
+    z_out.filelist.append(zinfo)
+    z_out.NameToInfo[zinfo.filename] = zinfo
+    z_out.start_dir = z_out.fp.tell()
+
+
 def process_apkg_file(apkg_path):
     """Unpacks, cleans (in parallel), and repacks an .apkg file."""
     output_path = apkg_path.replace('.apkg', '_cleaned.apkg')
-    
+
     with tempfile.TemporaryDirectory() as temp_dir:
         try:
             print(f"Unpacking {os.path.basename(apkg_path)}...")
             with zipfile.ZipFile(apkg_path, 'r') as z:
-                z.extractall(temp_dir)
+                member_names = z.namelist()
+            n_workers = min(cpu_count(), max(1, len(member_names)))
+            name_chunks = [member_names[i::n_workers] for i in range(n_workers)]
+            with ThreadPoolExecutor(max_workers=n_workers) as executor:
+                list(executor.map(lambda chunk: _extract_members(apkg_path, chunk, temp_dir),
+                                  name_chunks))
 
             db_file_path = next((os.path.join(temp_dir, f) for f in os.listdir(temp_dir) if f.endswith('.anki2')), None)
             if not db_file_path:
@@ -138,11 +502,40 @@ def process_apkg_file(apkg_path):
             clean_anki2_database(db_file_path)
 
             print(f"Repacking into {os.path.basename(output_path)}...")
-            with zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED) as z_out:
-                files_to_zip = [os.path.join(r, f) for r, _, files in os.walk(temp_dir) for f in files]
-                for file_path in tqdm(files_to_zip, desc="Repacking files", unit="file"):
-                    arcname = os.path.relpath(file_path, temp_dir)
-                    z_out.write(file_path, arcname)
+            files_to_zip = [os.path.join(r, f) for r, _, files in os.walk(temp_dir) for f in files]
+            # Write the .anki2 last so consumers of a partial archive see
+            # the media before the database.
+            files_to_zip.sort(key=lambda p: (p.endswith('.anki2'), p))
+
+            # Media members are bare numbers inside an .apkg; their real
+            # filenames (and extensions) live in the 'media' JSON map.
+            media_names = {}
+            media_map_path = os.path.join(temp_dir, 'media')
+            if os.path.isfile(media_map_path):
+                try:
+                    with open(media_map_path, encoding='utf-8') as f:
+                        media_names = json.load(f)
+                except (ValueError, OSError):
+                    media_names = {}
+
+            def member_args(file_path):
+                arcname = os.path.relpath(file_path, temp_dir)
+                real_name = media_names.get(arcname, arcname)
+                if os.path.splitext(real_name)[1].lower() in STORED_EXTENSIONS:
+                    return file_path, arcname, zipfile.ZIP_STORED
+                return file_path, arcname, zipfile.ZIP_DEFLATED
+
+            # Worker threads read and deflate members concurrently (zlib
+            # releases the GIL); the main thread appends the pre-compressed
+            # payloads in order, so the .anki2 still lands last. Level-1
+            # deflate: Anki readers don't care about ratio.
+            with zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED) as z_out, \
+                 ThreadPoolExecutor(max_workers=cpu_count()) as executor:
+                members = executor.map(lambda a: _deflate_member(*a),
+                                       map(member_args, files_to_zip))
+                for zinfo, payload in tqdm(members, total=len(files_to_zip),
+                                           desc="Repacking files", unit="file"):
+                    _write_raw_member(z_out, zinfo, payload)
             
             print(f"\nSuccess! Cleaned deck saved to: {output_path}")
 
@@ -195,12 +588,74 @@ class TestHtmlSimplification(unittest.TestCase):
         note_data = (1, "Front\x1f<p>Hello world</p>")
         self.assertIsNone(simplify_ruby_html(note_data))
 
+    def test_lxml_fallback_backend(self):
+        """Tests the lxml fallback path used when selectolax is absent."""
+        global LexborHTMLParser
+        saved = LexborHTMLParser
+        LexborHTMLParser = None
+        _simplify_html.cache_clear()
+        try:
+            self.test_full_example_with_link_filtering()
+            self.test_keeps_mixed_content_list()
+            self.test_removes_link_only_list()
+        finally:
+            LexborHTMLParser = saved
+            _simplify_html.cache_clear()
+
+    def test_backend_parity_on_malformed_ruby(self):
+        """Tests that both backends agree on tricky ruby shapes."""
+        if LexborHTMLParser is None:
+            self.skipTest("selectolax not installed")
+        cases = [
+            "<p><ruby><rb>結婚<rt>けっこん</ruby></p>",
+            # Trailing text after the reading inside an unclosed <rb>.
+            "<p><ruby><rb>X<rt>Y</rt>tail</ruby></p>",
+            # Multiple <rb>/<rt> pairs in one ruby.
+            "<p><ruby><rb>漢<rt>かん</rt><rb>字<rt>じ</rt></ruby></p>",
+            "<p><ruby><rb>X</rb><rt>Y</rt></ruby></p>",
+        ]
+        for case in cases:
+            self.assertEqual(_simplify_with_lexbor(case), _simplify_with_lxml(case),
+                             f"backends diverge on {case!r}")
+
+    def test_regex_branch_fixes_malformed_ruby(self):
+        """Tests that ruby-only notes are fixed without invoking the parser."""
+        html = "<p><ruby><rb>結婚<rt>けっこん</ruby></p>"
+        expected = "<p><ruby><rb>結婚</rb><rt>けっこん</rt></ruby></p>"
+        _simplify_html.cache_clear()
+        original_parse = lxml_html.fragment_fromstring
+        def fail_parse(*args, **kwargs):
+            raise AssertionError("ruby-only notes should not parse")
+        lxml_html.fragment_fromstring = fail_parse
+        try:
+            self.assertEqual(self.run_test_on_html(html), expected)
+        finally:
+            lxml_html.fragment_fromstring = original_parse
+
+    def test_fast_path_skips_parsing(self):
+        """Tests that notes without ruby/ul are skipped before any parsing."""
+        note_data = (1, "Front\x1f<p>Hello world</p>")
+        _simplify_html.cache_clear()
+        original_parse = lxml_html.fragment_fromstring
+        def fail_parse(*args, **kwargs):
+            raise AssertionError("fast path should not parse")
+        lxml_html.fragment_fromstring = fail_parse
+        try:
+            self.assertIsNone(simplify_ruby_html(note_data))
+        finally:
+            lxml_html.fragment_fromstring = original_parse
+
 if __name__ == '__main__':
     if len(sys.argv) > 1 and sys.argv[1] == '--test':
         print("Running unit tests...")
         sys.argv.pop(1)
         unittest.main(verbosity=2)
     elif len(sys.argv) == 2:
+        # The worker is interpreter-bound Python; PyPy's JIT runs it
+        # several times faster than CPython, and lxml/selectolax both
+        # ship PyPy wheels. Nudge, but don't require.
+        if platform.python_implementation() == 'CPython':
+            print("Tip: running this script under PyPy speeds up the cleaning phase considerably.")
         process_apkg_file(sys.argv[1])
     else:
         print("Usage:")